@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Callable, Dict, Optional
+
+
+# How often a waiting node re-checks for request cancellation
+CANCEL_POLL_SECONDS = 0.2
+
+# Cap on a single LLM call, so an abandoned worker cannot hold one open for minutes
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", 120))
+MIN_LLM_TIMEOUT_SECONDS = 1.0
+# Client retries would restart the timeout, letting one call run several times longer
+LLM_MAX_RETRIES = 0
+
+
+class RequestCancelled(Exception):
+    """Raised when a request is cancelled or runs out of time"""
+
+
+# Cancel event for one node that also carries the node's deadline
+class NodeSignal(threading.Event):
+    def __init__(self, deadline: Optional[float] = None):
+        super().__init__()
+        self.deadline = deadline
+
+
+# Cancellation and deadlines for one graph run
+class RunContext:
+    def __init__(self, request_timeout: Optional[float] = None, node_timeouts: Optional[Dict[str, float]] = None):
+        self.cancel_event = threading.Event()
+        self.deadline = time.monotonic() + request_timeout if request_timeout else None
+        self.node_timeouts = node_timeouts or {}
+        self.node_events = {}
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        with self.lock:
+            self.cancel_event.set()
+            for event in self.node_events.values():
+                event.set()
+
+    def node_event(self, node: str) -> threading.Event:
+        """Event set when this node should stop; pre-set if the request is already cancelled"""
+        with self.lock:
+            event = self.node_events.setdefault(node, NodeSignal(self.deadline))
+            if self.cancel_event.is_set():
+                event.set()
+            return event
+
+    def node_deadline(self, node: str) -> Optional[float]:
+        timeout = self.node_timeouts.get(node, self.node_timeouts.get("default"))
+        deadlines = [d for d in (self.deadline, time.monotonic() + timeout if timeout else None) if d is not None]
+        return min(deadlines) if deadlines else None
+
+    def run_node(self, node: str, fn: Callable, state: Dict):
+        """Run a node in a worker thread, abandoning it on timeout or cancellation"""
+        deadline = self.node_deadline(node)
+        event = self.node_event(node)
+        event.deadline = deadline
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=node)
+        future = executor.submit(fn, state)
+        executor.shutdown(wait=False)
+        try:
+            while True:
+                wait = CANCEL_POLL_SECONDS
+                if deadline is not None:
+                    wait = min(wait, max(deadline - time.monotonic(), 0))
+                try:
+                    return future.result(timeout=wait)
+                except FutureTimeout:
+                    if self.cancel_event.is_set():
+                        raise RequestCancelled(f"{node} cancelled")
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise RequestCancelled(f"{node} timed out")
+        except RequestCancelled:
+            # Stop the abandoned worker at its next LLM or search call
+            event.set()
+            raise
+
+
+# Registry of active runs, keyed by the run_id carried in graph state
+_contexts: Dict[str, RunContext] = {}
+_contexts_lock = threading.Lock()
+
+
+def new_run_id() -> str:
+    return uuid.uuid4().hex[:8]
+
+
+def register_run(run_id: str, request_timeout: Optional[float] = None,
+                 node_timeouts: Optional[Dict[str, float]] = None) -> RunContext:
+    context = RunContext(request_timeout, node_timeouts)
+    with _contexts_lock:
+        _contexts[run_id] = context
+        parent = _contexts.get(run_id.rsplit(":", 1)[0]) if ":" in run_id else None
+    # A child ("<parent>:<n>") registered after its parent was cancelled starts cancelled.
+    # cancel_run sets the parent before scanning for children, so no child is missed.
+    if parent is not None and parent.cancel_event.is_set():
+        context.cancel()
+    return context
+
+
+def get_run(run_id: str) -> Optional[RunContext]:
+    if not run_id:
+        return None
+    with _contexts_lock:
+        return _contexts.get(run_id)
+
+
+def cancel_run(run_id: str) -> bool:
+    """Cancel an in-flight run and any runs started under it ("<run_id>:<n>")"""
+    if not run_id:
+        return False
+    with _contexts_lock:
+        contexts = [
+            context for key, context in _contexts.items()
+            if key == run_id or key.startswith(run_id + ":")
+        ]
+    for context in contexts:
+        context.cancel()
+    return bool(contexts)
+
+
+def release_run(run_id: str):
+    with _contexts_lock:
+        _contexts.pop(run_id, None)
+
+
+def node_cancel_event(state: Dict, node: str) -> Optional[threading.Event]:
+    context = get_run(state.get("run_id", ""))
+    return context.node_event(node) if context is not None else None
+
+
+def check_cancelled(cancel_event: Optional[threading.Event], node: str):
+    if cancel_event is not None and cancel_event.is_set():
+        raise RequestCancelled(f"{node} cancelled")
+
+
+def llm_timeout(cancel_event: Optional[threading.Event]) -> float:
+    """LLM request timeout, capped by the node's remaining time"""
+    deadline = getattr(cancel_event, "deadline", None)
+    if deadline is None:
+        return LLM_TIMEOUT_SECONDS
+    return max(min(LLM_TIMEOUT_SECONDS, deadline - time.monotonic()), MIN_LLM_TIMEOUT_SECONDS)
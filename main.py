@@ -1,56 +1,119 @@
 from dotenv import load_dotenv
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
 from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_openai import ChatOpenAI
 from langgraph.graph import StateGraph, START, END
 from langgraph.types import Send
 
-from state import OverallState, InputState, OutputState, AgentRouter
-from market_research_agent import market_research_agent
-from marketing_strategy_agent import marketing_strategy_agent
-from content_delivery_agent import content_delivery_agent
+from state import OverallState, InputState, OutputState, AgentRouter, BatchRouter, empty_usage, add_usage, record_llm_usage
+from market_research_agent import market_research_agent, plan_market_research
+from marketing_strategy_agent import marketing_strategy_agent, plan_marketing_strategy
+from content_delivery_agent import content_delivery_agent, plan_content_delivery
+from search_planner import search_planner
+from speculation import (
+    guess_likely_agents, new_speculation_id, start_speculation,
+    resolve_speculation, finish_speculation
+)
+from search_cache import get_search_cache, open_search_cache, close_search_cache
+from cancellation import (
+    RequestCancelled, new_run_id, register_run, get_run, release_run, cancel_run,
+    node_cancel_event, check_cancelled, llm_timeout, LLM_TIMEOUT_SECONDS, LLM_MAX_RETRIES
+)
 
 load_dotenv()
 
 openai_api_key = os.getenv("OPENAI_API_KEY")
 
-llm = ChatOpenAI(model='gpt-4o', api_key=openai_api_key)
+llm = ChatOpenAI(model='gpt-4o', api_key=openai_api_key, timeout=LLM_TIMEOUT_SECONDS, max_retries=LLM_MAX_RETRIES)
+
+# Optional timeouts in seconds; unset means no limit
+DEFAULT_REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT_SECONDS", 0)) or None
+DEFAULT_NODE_TIMEOUT = float(os.getenv("NODE_TIMEOUT_SECONDS", 0)) or None
+
+# Graph nodes that accept a timeout, plus "default" for all of them
+TIMEOUT_NODES = ("default", "supervisor", "search_planner", "market_research", "marketing_strategy", "content_delivery")
+
+# Batch settings
+ROUTING_BATCH_SIZE = 20
+ROUTING_WORKERS = 4
+DEFAULT_BATCH_CONCURRENCY = 4
+
+# Planning steps that can be started before routing completes
+AGENT_PLANNERS = {
+    "market_research": plan_market_research,
+    "marketing_strategy": plan_marketing_strategy,
+    "content_delivery": plan_content_delivery
+}
+
+# Prompt for the routing LLM
+ROUTER_PROMPT = """
+You are an agent router for a marketing system with three specialized sub-agents:
+1. market_research - Analyzes market, industry, competitors for a product/service
+2. marketing_strategy - Develops strategies to penetrate markets and differentiate products
+3. content_delivery - Creates social media content and advertising ideas aligned with trends
+
+Based on the user's request, determine which agent(s) should be activated.
+Return ONLY the agents that are explicitly or implicitly requested.
+"""
+
+BATCH_ROUTER_PROMPT = ROUTER_PROMPT + """
+You will receive a numbered list of independent requests.
+Return one route per request, using the request's number as its index.
+"""
 
 # Supervisor function to determine which agents to run
 def supervisor(state: OverallState) -> OverallState:
     
     user_input = state["user_input"]
+    usage = empty_usage()
     
     # Check if agents are already pre-selected (from specific_agents parameter)
     if "selected_agents" in state and state["selected_agents"]:
         print(f"Using pre-selected agents: {state['selected_agents']}")
         selected_agents = state["selected_agents"]
     else:
-        # Prompt for the routing LLM
-        system_prompt = """
-        You are an agent router for a marketing system with three specialized sub-agents:
-        1. market_research - Analyzes market, industry, competitors for a product/service
-        2. marketing_strategy - Develops strategies to penetrate markets and differentiate products
-        3. content_delivery - Creates social media content and advertising ideas aligned with trends
+        # Speculatively start the likely agents' planning while routing runs
+        speculation_id = state.get("speculation_id", "")
+        cancel_event = node_cancel_event(state, "supervisor")
+        check_cancelled(cancel_event, "supervisor")
+        if speculation_id:
+            likely_agents = guess_likely_agents(user_input)
+            print(f"Speculatively planning agents: {likely_agents}")
+            start_speculation(
+                speculation_id,
+                user_input,
+                {
+                    agent: partial(AGENT_PLANNERS[agent], search_cache=get_search_cache(state))
+                    for agent in likely_agents
+                },
+                get_run(state.get("run_id", ""))
+            )
         
-        Based on the user's request, determine which agent(s) should be activated.
-        Return ONLY the agents that are explicitly or implicitly requested.
-        """
-        
-        response = llm.with_structured_output(AgentRouter).invoke([
-            SystemMessage(content=system_prompt),
+        router_llm = ChatOpenAI(model='gpt-4o', api_key=openai_api_key, timeout=llm_timeout(cancel_event), max_retries=LLM_MAX_RETRIES)
+        response = router_llm.with_structured_output(AgentRouter, include_raw=True).invoke([
+            SystemMessage(content=ROUTER_PROMPT),
             HumanMessage(content=user_input)
         ])
+        record_llm_usage(usage, response["raw"])
+        if response["parsing_error"] is not None:
+            raise response["parsing_error"]
+        
+        print(f"Auto-routed agents: {response['parsed']}")
+        selected_agents = response["parsed"]["selected_agents"]
         
-        print(f"Auto-routed agents: {response}")
-        selected_agents = response["selected_agents"]
+        if speculation_id:
+            resolve_speculation(speculation_id, selected_agents)
     
     return {
         "user_input": user_input,
         "selected_agents": selected_agents,
         "agent_responses": state.get("agent_responses", {}),
         "execution_progress": state.get("execution_progress", []),
-        "graph_output": state.get("graph_output", "")
+        "graph_output": state.get("graph_output", ""),
+        "usage": usage
     }
 
 
@@ -59,6 +122,7 @@ def collector(state: OverallState) -> OutputState:
 
     selected_agents = state["selected_agents"]
     completed_agents = state["execution_progress"]
+    timed_out_agents = state.get("timed_out_agents", [])
     
     all_completed = True
     for agent in selected_agents:
@@ -79,35 +143,102 @@ def collector(state: OverallState) -> OutputState:
                 summary += "## Marketing Strategy\n"
             elif agent == "content_delivery":
                 summary += "## Content Ideas\n"
+            
+            # Degraded completion: keep what finished, mark the rest
+            if agent in timed_out_agents:
+                summary += "*Timed out before completing.*\n\n"
+                continue
                 
             summary += responses.get(agent, "No response available") + "\n\n"
         
+        context = get_run(state.get("run_id", ""))
+        if context is not None and context.cancel_event.is_set():
+            status = "cancelled"
+        elif timed_out_agents:
+            status = "partial"
+        else:
+            status = "complete"
+        
+        # A degraded run must not block on speculative work it no longer needs
+        speculation_report = finish_speculation(state.get("speculation_id", ""), wait=status == "complete")
+        
         return {
+            "status": status,
             "graph_output": summary,
-            "agent_responses": responses
+            "agent_responses": responses,
+            "speculation_report": speculation_report,
+            "usage": add_usage(
+                dict(speculation_report.get("promoted_usage", {})),
+                speculation_report.get("wasted_usage", {})
+            ),
+            "search_report": state.get("search_report", {})
         }
 
+# Run a node under its run's cancellation and timeouts.
+# Without a fallback there is no degraded result and the cancellation propagates.
+def guarded_node(name, node_fn, fallback=None):
+    
+    def node(state: OverallState):
+        context = get_run(state.get("run_id", ""))
+        if context is None:
+            return node_fn(state)
+        try:
+            return context.run_node(name, node_fn, state)
+        except RequestCancelled as e:
+            if fallback is None:
+                raise
+            print(f"{e}, continuing without it")
+            return fallback
+    
+    return node
+
+
+def agent_timeout_fallback(agent):
+    return {"execution_progress": [agent], "timed_out_agents": [agent]}
+
+
 def create_marketing_agent_graph():
     
     builder = StateGraph(OverallState, input=OverallState, output=OutputState)
     
-    builder.add_node("supervisor", supervisor)
-    builder.add_node("market_research", market_research_agent)
-    builder.add_node("marketing_strategy", marketing_strategy_agent)
-    builder.add_node("content_delivery", content_delivery_agent)
+    builder.add_node("supervisor", guarded_node("supervisor", supervisor))
+    builder.add_node("search_planner", guarded_node("search_planner", search_planner, {"search_plans": {}}))
+    builder.add_node("market_research", guarded_node(
+        "market_research", market_research_agent, agent_timeout_fallback("market_research")))
+    builder.add_node("marketing_strategy", guarded_node(
+        "marketing_strategy", marketing_strategy_agent, agent_timeout_fallback("marketing_strategy")))
+    builder.add_node("content_delivery", guarded_node(
+        "content_delivery", content_delivery_agent, agent_timeout_fallback("content_delivery")))
     builder.add_node("collector", collector)
     
     builder.add_edge(START, "supervisor")
     
     # Define routing logic
-    def supervisor_branching_logic(state: OverallState):
+    def agent_branching_logic(state: OverallState):
         selected_agents = state["selected_agents"]
         return [Send(agent, state) for agent in selected_agents]
     
+    def supervisor_branching_logic(state: OverallState):
+        # Optionally plan all agents' searches as one shared wave first
+        if state.get("search_planning"):
+            return "search_planner"
+        return agent_branching_logic(state)
+    
     # Add conditional edges from supervisor to agents
     builder.add_conditional_edges(
         "supervisor",
         supervisor_branching_logic,
+        {
+            "search_planner": "search_planner",
+            "market_research": "market_research",
+            "marketing_strategy": "marketing_strategy",
+            "content_delivery": "content_delivery"
+        }
+    )
+    
+    builder.add_conditional_edges(
+        "search_planner",
+        agent_branching_logic,
         {
             "market_research": "market_research",
             "marketing_strategy": "marketing_strategy",
@@ -126,17 +257,217 @@ def create_marketing_agent_graph():
 # Initialize the graph
 graph = create_marketing_agent_graph()
 
-def run_marketing_agent(user_query):
+def validate_timeouts(request_timeout=None, node_timeouts=None):
+    for node, timeout in (node_timeouts or {}).items():
+        if node not in TIMEOUT_NODES:
+            raise ValueError(f"Unknown node in node_timeouts: {node}")
+        if timeout is None or timeout <= 0:
+            raise ValueError(f"Timeout for {node} must be a positive number of seconds")
+    if request_timeout is not None and request_timeout <= 0:
+        raise ValueError("request_timeout must be a positive number of seconds")
+
+def run_marketing_agent(user_query, speculative=False, search_planning=False, selected_agents=None,
+                        run_id=None, request_timeout=None, node_timeouts=None, search_cache_id=None):
+    
+    validate_timeouts(request_timeout, node_timeouts)
+    
+    # run_id lets the caller cancel the run from another thread with cancel_run(run_id)
+    run_id = run_id or new_run_id()
+    timeouts = {"default": DEFAULT_NODE_TIMEOUT}
+    timeouts.update(node_timeouts or {})
+    register_run(run_id, request_timeout or DEFAULT_REQUEST_TIMEOUT, timeouts)
     
     state = {
         "user_input": user_query,
-        "selected_agents": [],
+        "selected_agents": selected_agents or [],
         "agent_responses": {},
         "execution_progress": [],
-        "graph_output": ""
+        "graph_output": "",
+        "run_id": run_id,
+        "speculation_id": new_speculation_id() if speculative else "",
+        "search_planning": search_planning,
+        "search_cache_id": search_cache_id or ""
     }
     
-    result = graph.invoke(state)
+    try:
+        result = graph.invoke(state)
+    except RequestCancelled as e:
+        # Cancelled or out of time before any agent ran (e.g. during routing)
+        print(f"Run {run_id} stopped early: {e}")
+        context = get_run(run_id)
+        result = {
+            "status": "cancelled" if context is not None and context.cancel_event.is_set() else "timed_out",
+            "graph_output": "",
+            "agent_responses": {},
+            "selected_agents": selected_agents or [],
+            "timed_out_agents": [],
+            "usage": {}
+        }
+    finally:
+        # Release speculative work if the graph failed before the collector ran
+        finish_speculation(state["speculation_id"], wait=False)
+        release_run(run_id)
     
     return result
 
+
+# Route many queries with one structured LLM call per chunk
+def route_chunk(queries, cancel_event=None):
+    """Route up to ROUTING_BATCH_SIZE queries in one LLM call; returns their routes and usage"""
+    
+    check_cancelled(cancel_event, "batch_router")
+    usage = empty_usage()
+    routes = [[] for _ in queries]
+    router = llm.with_structured_output(BatchRouter, include_raw=True)
+    numbered = "\n".join(f"{index}. {query}" for index, query in enumerate(queries))
+    
+    response = router.invoke([
+        SystemMessage(content=BATCH_ROUTER_PROMPT),
+        HumanMessage(content=numbered)
+    ])
+    record_llm_usage(usage, response["raw"])
+    
+    # Queries left without a route fall back to the supervisor's own routing
+    for route in (response["parsed"] or {}).get("routes", []):
+        if 0 <= route["index"] < len(queries):
+            routes[route["index"]] = route["selected_agents"]
+    
+    return routes, usage
+
+
+def run_marketing_agent_batch(queries, max_concurrency=DEFAULT_BATCH_CONCURRENCY, batch_id=None, selected_agents=None,
+                              speculative=False, search_planning=False, request_timeout=None, node_timeouts=None):
+    """
+    Run many queries, yielding an "item" event per query as it completes and
+    a final "report" event. Cancel the whole batch with cancel_run(batch_id).
+    Pass selected_agents to run the same agents for every query without routing.
+    speculative only affects queries the batch router left unrouted, since
+    those are the only ones routed again by the supervisor.
+    """
+    # Validate on call rather than on first iteration of the generator
+    if not isinstance(max_concurrency, int) or max_concurrency < 1:
+        raise ValueError("max_concurrency must be a positive integer")
+    validate_timeouts(request_timeout, node_timeouts)
+    
+    return _run_batch(queries, max_concurrency, batch_id or new_run_id(), selected_agents,
+                      speculative, search_planning, request_timeout, node_timeouts)
+
+
+def _run_batch(queries, max_concurrency, batch_id, selected_agents,
+               speculative, search_planning, request_timeout, node_timeouts):
+    
+    batch_context = register_run(batch_id)
+    open_search_cache(batch_id)
+    start_time = time.monotonic()
+    usage = empty_usage()
+    
+    # Identical queries are routed and run once, then reported for every index
+    groups = {}
+    for index, query in enumerate(queries):
+        groups.setdefault(" ".join(query.lower().split()), []).append(index)
+    groups = list(groups.values())
+    
+    def run_item(group_number, item_agents):
+        if batch_context.cancel_event.is_set():
+            raise RequestCancelled("batch cancelled")
+        return run_marketing_agent(
+            queries[groups[group_number][0]],
+            speculative=speculative,
+            search_planning=search_planning,
+            selected_agents=item_agents,
+            run_id=f"{batch_id}:{group_number}",
+            request_timeout=request_timeout,
+            node_timeouts=node_timeouts,
+            search_cache_id=batch_id
+        )
+    
+    counts = {"complete": 0, "partial": 0, "timed_out": 0, "cancelled": 0, "error": 0}
+    done = 0
+    finished = False
+    executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="batch")
+    router_executor = ThreadPoolExecutor(max_workers=ROUTING_WORKERS, thread_name_prefix="batch-router")
+    routes = [selected_agents or [] for _ in groups]
+    route_futures = {}
+    item_futures = {}
+    
+    try:
+        if selected_agents:
+            item_futures = {
+                executor.submit(run_item, group_number, selected_agents): group_number
+                for group_number in range(len(groups))
+            }
+        else:
+            # Route chunks concurrently; each chunk's items start as soon as its routes return
+            for start in range(0, len(groups), ROUTING_BATCH_SIZE):
+                chunk = [queries[indexes[0]] for indexes in groups[start:start + ROUTING_BATCH_SIZE]]
+                future = router_executor.submit(route_chunk, chunk, batch_context.cancel_event)
+                route_futures[future] = (start, len(chunk))
+        
+        pending = set(route_futures) | set(item_futures)
+        while pending:
+            completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in completed:
+                if future in route_futures:
+                    start, size = route_futures[future]
+                    try:
+                        chunk_routes, chunk_usage = future.result()
+                        add_usage(usage, chunk_usage)
+                    except Exception as e:
+                        # A failed chunk falls back to the supervisor's own routing
+                        print(f"Batch routing failed for queries {start}-{start + size - 1}: {e}")
+                        chunk_routes = [[] for _ in range(size)]
+                    for group_number, item_agents in enumerate(chunk_routes, start):
+                        routes[group_number] = item_agents
+                        item_future = executor.submit(run_item, group_number, item_agents)
+                        item_futures[item_future] = group_number
+                        pending.add(item_future)
+                    continue
+                group_number = item_futures[future]
+                item = {"selected_agents": routes[group_number]}
+                try:
+                    result = future.result()
+                    item.update({
+                        "status": result.get("status") or "complete",
+                        "selected_agents": result.get("selected_agents") or routes[group_number],
+                        "results": result.get("agent_responses", {}),
+                        "formatted_output": result.get("graph_output", ""),
+                        "timed_out_agents": result.get("timed_out_agents", []),
+                        "usage": result.get("usage", {})
+                    })
+                    add_usage(usage, item["usage"])
+                except RequestCancelled as e:
+                    item.update({"status": "cancelled", "error": str(e)})
+                except Exception as e:
+                    item.update({"status": "error", "error": str(e)})
+                
+                for index in groups[group_number]:
+                    done += 1
+                    counts[item["status"]] = counts.get(item["status"], 0) + 1
+                    yield {
+                        "type": "item",
+                        "index": index,
+                        "query": queries[index],
+                        **item,
+                        "progress": {"done": done, "total": len(queries)}
+                    }
+        
+        finished = True
+    finally:
+        # Stop outstanding work when the consumer goes away early
+        if not finished:
+            cancel_run(batch_id)
+        router_executor.shutdown(wait=finished, cancel_futures=not finished)
+        executor.shutdown(wait=finished, cancel_futures=not finished)
+        release_run(batch_id)
+        search_cache = close_search_cache(batch_id)
+    
+    yield {
+        "type": "report",
+        "batch_id": batch_id,
+        "total": len(queries),
+        "unique_queries": len(groups),
+        **counts,
+        "usage": usage,
+        "search_cache": search_cache,
+        "elapsed_seconds": round(time.monotonic() - start_time, 2)
+    }
@@ -3,58 +3,35 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain_core.tools import tool
 from langchain_openai import ChatOpenAI
 import os
-import json
-import requests
-from typing import List, Dict
-from state import OverallState
+from typing import Dict
+from state import OverallState, empty_usage, add_usage, record_llm_usage
+from speculation import claim_plan
+from cancellation import node_cancel_event, check_cancelled, llm_timeout, LLM_MAX_RETRIES
+from search_cache import get_search_cache
+from search_tools import SerperSearchTool, format_search_results, shared_evidence_message
 
 
 parser = StrOutputParser()
 
-# Serper Search Tool
-class SerperSearchTool:
-    def __init__(self, api_key=None):
-        self.api_key = api_key or os.getenv("SERPER_API_KEY")
-        
-    def search(self, query: str, num_results: int = 5) -> List[Dict]:
-        
-        url = "https://google.serper.dev/search"
-        payload = json.dumps({
-            "q": query,
-            "num": num_results
-        })
-        headers = {
-            'X-API-KEY': self.api_key,
-            'Content-Type': 'application/json'
-        }
-        response = requests.request("POST", url, headers=headers, data=payload)
-        return response.json()
+# Search tool exposed to the LLM
+def build_tools(search_tool: SerperSearchTool):
 
-
-# Market Research Agent
-def market_research_agent(state: OverallState) -> OverallState:
-   
-    user_input = state["user_input"]
-    
-    llm = ChatOpenAI(model='gpt-4o', api_key=os.getenv("OPENAI_API_KEY"))
-    
-    search_tool = SerperSearchTool()
-    
-    # Define the search tool function for the LLM
     @tool
     def deep_search(query: str) -> str:
         """Search for detailed information about the market, industry, and competitors."""
-        results = search_tool.search(query)
-        # Format results to be more readable
-        formatted_results = []
-        for idx, result in enumerate(results.get("organic", [])):
-            formatted_results.append(f"{idx+1}. {result.get('title', 'No title')}")
-            formatted_results.append(f"   URL: {result.get('link', 'No link')}")
-            formatted_results.append(f"   Snippet: {result.get('snippet', 'No snippet')}")
-            formatted_results.append("")
-        return "\n".join(formatted_results)
-    
-    tools = [deep_search]
+        return format_search_results(search_tool.search(query))
+
+    return [deep_search]
+
+
+# Tool-planning LLM call only; its tool calls are the agent's search intents
+def request_market_research_searches(user_input: str, agent_responses: Dict = None, cancel_event=None) -> Dict:
+
+    check_cancelled(cancel_event, "market_research")
+
+    llm = ChatOpenAI(model='gpt-4o', api_key=os.getenv("OPENAI_API_KEY"), timeout=llm_timeout(cancel_event), max_retries=LLM_MAX_RETRIES)
+
+    tools = build_tools(SerperSearchTool())
     
     system_prompt = """
     You are a specialized Market Research Agent. Your job is to thoroughly analyze:
@@ -77,10 +54,29 @@ def market_research_agent(state: OverallState) -> OverallState:
     response = llm.bind_tools(tools).invoke(conversation)
 
     conversation.append(response)
+    usage = record_llm_usage(empty_usage(), response)
+
+    return {"conversation": conversation, "usage": usage}
+
+
+# Planning step: the tool-planning LLM call plus the searches it requests.
+# It does not depend on routing, so the supervisor may start it speculatively.
+def plan_market_research(user_input: str, agent_responses: Dict = None, cancel_event=None, search_cache=None) -> Dict:
+
+    plan = request_market_research_searches(user_input, agent_responses, cancel_event)
+    conversation = plan["conversation"]
+    usage = plan["usage"]
+    response = conversation[-1]
+
+    search_tool = SerperSearchTool(cache=search_cache)
+    deep_search = build_tools(search_tool)[0]
     
     # Handle any tool calls
     if hasattr(response, "tool_calls") and response.tool_calls:
         for tool_call in response.tool_calls:
+            # Skip remaining searches once the plan is discarded or cancelled
+            if cancel_event is not None and cancel_event.is_set():
+                break
             if tool_call["name"] == "deep_search":
                 search_args = tool_call["args"]["query"]
                 
@@ -92,9 +88,39 @@ def market_research_agent(state: OverallState) -> OverallState:
                     tool_call_id=tool_call["id"]
                 )
                 conversation.append(tool_message)
-                
-        # Get final response after tool use
+
+    usage["serper_calls"] += search_tool.calls
+    return {"conversation": conversation, "usage": usage}
+
+
+# Market Research Agent
+def market_research_agent(state: OverallState) -> OverallState:
+   
+    cancel_event = node_cancel_event(state, "market_research")
+
+    # Plans come from the shared search planning stage, speculation, or are made here
+    plan = state.get("search_plans", {}).get("market_research") or claim_plan(state, "market_research")
+    usage = empty_usage()
+    if plan is None:
+        plan = plan_market_research(state["user_input"], state["agent_responses"], cancel_event, get_search_cache(state))
+        # Planner and speculation report their own plans' cost, even if this node times out
+        add_usage(usage, plan["usage"])
+
+    conversation = plan["conversation"]
+    response = conversation[-1]
+
+    # Read the rest of the request's shared evidence pool, if the search planner built one
+    evidence = shared_evidence_message(state.get("evidence_pool", {}), conversation)
+
+    # Get final response after tool use, or to take the shared evidence into account
+    if isinstance(response, ToolMessage) or evidence is not None:
+        check_cancelled(cancel_event, "market_research")
+        if evidence is not None:
+            conversation.append(evidence)
+        llm = ChatOpenAI(model='gpt-4o', api_key=os.getenv("OPENAI_API_KEY"), timeout=llm_timeout(cancel_event), max_retries=LLM_MAX_RETRIES)
+        tools = build_tools(SerperSearchTool())
         response = llm.bind_tools(tools).invoke(conversation)
+        record_llm_usage(usage, response)
         
     
     final_output = parser.invoke(response)
@@ -102,5 +128,6 @@ def market_research_agent(state: OverallState) -> OverallState:
     
     return {
         "agent_responses": {"market_research": final_output},
-        "execution_progress": ["market_research"]
+        "execution_progress": ["market_research"],
+        "usage": usage
     } 
\ No newline at end of file
@@ -3,60 +3,37 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain_core.tools import tool
 from langchain_openai import ChatOpenAI
 import os
-import json
-import requests
-from typing import List, Dict
-from state import OverallState
+from typing import Dict
+from state import OverallState, empty_usage, add_usage, record_llm_usage
+from speculation import claim_plan
+from cancellation import node_cancel_event, check_cancelled, llm_timeout, LLM_MAX_RETRIES
+from search_cache import get_search_cache
+from search_tools import SerperSearchTool, format_search_results, shared_evidence_message
 
 parser = StrOutputParser()
 
-# Serper Search Tool
-class SerperSearchTool:
-    def __init__(self, api_key=None):
-        self.api_key = api_key or os.getenv("SERPER_API_KEY")
-        
-    def search(self, query: str, num_results: int = 5) -> List[Dict]:
-    
-        url = "https://google.serper.dev/search"
-        payload = json.dumps({
-            "q": query,
-            "num": num_results
-        })
-        headers = {
-            'X-API-KEY': self.api_key,
-            'Content-Type': 'application/json'
-        }
-        response = requests.request("POST", url, headers=headers, data=payload)
-        return response.json()
-    
+# Search tool exposed to the LLM
+def build_tools(search_tool: SerperSearchTool):
 
-# Marketing Strategy Agent
-def marketing_strategy_agent(state: OverallState) -> OverallState:
-   
-    user_input = state["user_input"]
-    
-    llm = ChatOpenAI(model='gpt-4o', api_key=os.getenv("OPENAI_API_KEY"))
-    
-    # Use market research if available
-    market_research = state["agent_responses"].get("market_research", "")
-    
-    search_tool = SerperSearchTool()
-    
-    # Define the search tool function for the LLM
     @tool
     def strategy_search(query: str) -> str:
         """Search for marketing strategies, case studies, and successful approaches."""
-        results = search_tool.search(query)
-        # Format results to be more readable
-        formatted_results = []
-        for idx, result in enumerate(results.get("organic", [])):
-            formatted_results.append(f"{idx+1}. {result.get('title', 'No title')}")
-            formatted_results.append(f"   URL: {result.get('link', 'No link')}")
-            formatted_results.append(f"   Snippet: {result.get('snippet', 'No snippet')}")
-            formatted_results.append("")
-        return "\n".join(formatted_results)
+        return format_search_results(search_tool.search(query))
+
+    return [strategy_search]
+
+
+# Tool-planning LLM call only; its tool calls are the agent's search intents
+def request_marketing_strategy_searches(user_input: str, agent_responses: Dict = None, cancel_event=None) -> Dict:
+
+    check_cancelled(cancel_event, "marketing_strategy")
+
+    llm = ChatOpenAI(model='gpt-4o', api_key=os.getenv("OPENAI_API_KEY"), timeout=llm_timeout(cancel_event), max_retries=LLM_MAX_RETRIES)
     
-    tools = [strategy_search]
+    # Use market research if available
+    market_research = (agent_responses or {}).get("market_research", "")
+
+    tools = build_tools(SerperSearchTool())
     
     system_prompt = """
     You are a specialized Marketing Strategy Agent. Your job is to develop innovative marketing strategies:
@@ -83,10 +60,29 @@ def marketing_strategy_agent(state: OverallState) -> OverallState:
     response = llm.bind_tools(tools).invoke(conversation)
     
     conversation.append(response)
+    usage = record_llm_usage(empty_usage(), response)
+
+    return {"conversation": conversation, "usage": usage}
+
+
+# Planning step: the tool-planning LLM call plus the searches it requests.
+# It does not depend on routing, so the supervisor may start it speculatively.
+def plan_marketing_strategy(user_input: str, agent_responses: Dict = None, cancel_event=None, search_cache=None) -> Dict:
+
+    plan = request_marketing_strategy_searches(user_input, agent_responses, cancel_event)
+    conversation = plan["conversation"]
+    usage = plan["usage"]
+    response = conversation[-1]
+
+    search_tool = SerperSearchTool(cache=search_cache)
+    strategy_search = build_tools(search_tool)[0]
     
     # Handle any tool calls
     if hasattr(response, "tool_calls") and response.tool_calls:
         for tool_call in response.tool_calls:
+            # Skip remaining searches once the plan is discarded or cancelled
+            if cancel_event is not None and cancel_event.is_set():
+                break
             if tool_call["name"] == "strategy_search":
                 search_args = tool_call["args"]["query"]
                 
@@ -98,14 +94,45 @@ def marketing_strategy_agent(state: OverallState) -> OverallState:
                     tool_call_id=tool_call["id"]
                 )
                 conversation.append(tool_message)
-                
-        # Get final response after all tools have been processed
+
+    usage["serper_calls"] += search_tool.calls
+    return {"conversation": conversation, "usage": usage}
+
+
+# Marketing Strategy Agent
+def marketing_strategy_agent(state: OverallState) -> OverallState:
+   
+    cancel_event = node_cancel_event(state, "marketing_strategy")
+
+    # Plans come from the shared search planning stage, speculation, or are made here
+    plan = state.get("search_plans", {}).get("marketing_strategy") or claim_plan(state, "marketing_strategy")
+    usage = empty_usage()
+    if plan is None:
+        plan = plan_marketing_strategy(state["user_input"], state["agent_responses"], cancel_event, get_search_cache(state))
+        # Planner and speculation report their own plans' cost, even if this node times out
+        add_usage(usage, plan["usage"])
+
+    conversation = plan["conversation"]
+    response = conversation[-1]
+
+    # Read the rest of the request's shared evidence pool, if the search planner built one
+    evidence = shared_evidence_message(state.get("evidence_pool", {}), conversation)
+
+    # Get final response after tool use, or to take the shared evidence into account
+    if isinstance(response, ToolMessage) or evidence is not None:
+        check_cancelled(cancel_event, "marketing_strategy")
+        if evidence is not None:
+            conversation.append(evidence)
+        llm = ChatOpenAI(model='gpt-4o', api_key=os.getenv("OPENAI_API_KEY"), timeout=llm_timeout(cancel_event), max_retries=LLM_MAX_RETRIES)
+        tools = build_tools(SerperSearchTool())
         response = llm.bind_tools(tools).invoke(conversation)
+        record_llm_usage(usage, response)
     
     final_response = parser.invoke(response)
     
     
     return {
         "agent_responses": {"marketing_strategy": final_response},
-        "execution_progress": ["marketing_strategy"]
+        "execution_progress": ["marketing_strategy"],
+        "usage": usage
     } 
\ No newline at end of file
@@ -0,0 +1,59 @@
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional
+
+
+# Serper results shared by every run in a batch
+class SearchCache:
+    def __init__(self):
+        self.entries: Dict[tuple, Future] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_fetch(self, key: tuple, fetch: Callable):
+        """Return a cached result; concurrent callers for the same key share one fetch"""
+        with self.lock:
+            future = self.entries.get(key)
+            owner = future is None
+            if owner:
+                future = self.entries[key] = Future()
+                self.misses += 1
+            else:
+                self.hits += 1
+        if owner:
+            try:
+                future.set_result(fetch())
+            except Exception as e:
+                # Failed searches are not cached, so a later caller retries
+                with self.lock:
+                    self.entries.pop(key, None)
+                future.set_exception(e)
+        return future.result()
+
+    def stats(self) -> Dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+# Registry of caches, keyed by the search_cache_id carried in graph state
+_caches: Dict[str, SearchCache] = {}
+_caches_lock = threading.Lock()
+
+
+def open_search_cache(cache_id: str) -> SearchCache:
+    with _caches_lock:
+        return _caches.setdefault(cache_id, SearchCache())
+
+
+def close_search_cache(cache_id: str) -> Dict:
+    with _caches_lock:
+        cache = _caches.pop(cache_id, None)
+    return cache.stats() if cache is not None else {}
+
+
+def get_search_cache(state: Dict) -> Optional[SearchCache]:
+    cache_id = state.get("search_cache_id")
+    if not cache_id:
+        return None
+    with _caches_lock:
+        return _caches.get(cache_id)
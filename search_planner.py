@@ -0,0 +1,118 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from langchain_core.messages import ToolMessage
+
+from state import OverallState, empty_usage, add_usage
+from speculation import promoted_agents
+from cancellation import node_cancel_event, check_cancelled
+from search_cache import get_search_cache
+from search_tools import SerperSearchTool, format_search_results
+from market_research_agent import request_market_research_searches
+from marketing_strategy_agent import request_marketing_strategy_searches
+from content_delivery_agent import request_content_delivery_searches
+
+
+# Tool-planning calls that expose each agent's search intents
+SEARCH_REQUESTERS = {
+    "market_research": request_market_research_searches,
+    "marketing_strategy": request_marketing_strategy_searches,
+    "content_delivery": request_content_delivery_searches
+}
+
+MAX_SEARCH_WORKERS = 8
+
+STOPWORDS = {"a", "an", "and", "the", "for", "of", "in", "on", "to", "with", "best", "top", "how", "what"}
+
+
+def query_terms(query: str) -> frozenset:
+    return frozenset(word for word in re.findall(r"[a-z0-9]+", query.lower()) if word not in STOPWORDS)
+
+
+def merge_queries(queries: List[str]) -> Dict[str, str]:
+    """
+    Map every query to the canonical query that will actually be searched.
+    Only queries with identical terms (ignoring case, punctuation, word order
+    and stopwords) are merged; partial overlaps often ask for different things.
+    """
+    canonical = {}
+    mapping = {}
+    for query in queries:
+        mapping[query] = canonical.setdefault(query_terms(query), query)
+    return mapping
+
+
+def run_search_batch(queries: List[str], search_cache=None, cancel_event=None):
+    """Run unique queries as one concurrent wave; returns the evidence pool and real Serper calls"""
+    if not queries:
+        return {}, 0
+    search_tool = SerperSearchTool(cache=search_cache)
+
+    def run_query(query):
+        check_cancelled(cancel_event, "search_planner")
+        return format_search_results(search_tool.search(query))
+
+    with ThreadPoolExecutor(max_workers=min(len(queries), MAX_SEARCH_WORKERS)) as executor:
+        evidence_pool = dict(zip(queries, executor.map(run_query, queries)))
+    return evidence_pool, search_tool.calls
+
+
+# Search Planner: one search wave shared by all selected agents
+def search_planner(state: OverallState) -> OverallState:
+
+    user_input = state["user_input"]
+    agent_responses = state.get("agent_responses", {})
+    cancel_event = node_cancel_event(state, "search_planner")
+
+    # Agents holding a promoted speculative plan have already searched
+    already_planned = promoted_agents(state.get("speculation_id", ""))
+    agents = [agent for agent in state["selected_agents"] if agent not in already_planned]
+
+    # Collect each agent's search intents concurrently
+    with ThreadPoolExecutor(max_workers=max(len(agents), 1)) as executor:
+        drafts = dict(zip(agents, executor.map(
+            lambda agent: SEARCH_REQUESTERS[agent](user_input, agent_responses, cancel_event), agents
+        )))
+
+    requested = []
+    for draft in drafts.values():
+        response = draft["conversation"][-1]
+        for tool_call in getattr(response, "tool_calls", None) or []:
+            requested.append(tool_call["args"]["query"])
+
+    check_cancelled(cancel_event, "search_planner")
+    mapping = merge_queries(requested)
+    unique_queries = list(dict.fromkeys(mapping.values()))
+    evidence_pool, serper_calls = run_search_batch(unique_queries, get_search_cache(state), cancel_event)
+    print(f"Search planner merged {len(requested)} queries into {len(unique_queries)} searches")
+
+    # Answer every agent's tool calls from the shared evidence pool
+    usage = empty_usage()
+    search_plans = {}
+    for agent, draft in drafts.items():
+        conversation = draft["conversation"]
+        response = conversation[-1]
+        for tool_call in getattr(response, "tool_calls", None) or []:
+            conversation.append(ToolMessage(
+                content=evidence_pool[mapping[tool_call["args"]["query"]]],
+                name=tool_call["name"],
+                tool_call_id=tool_call["id"]
+            ))
+        add_usage(usage, draft["usage"])
+        search_plans[agent] = {"conversation": conversation, "usage": draft["usage"]}
+    usage["serper_calls"] += serper_calls
+
+    return {
+        "search_plans": search_plans,
+        # Drafts and searches are counted here, so they survive an agent timing out
+        "usage": usage,
+        "evidence_pool": evidence_pool,
+        "search_report": {
+            "requested_queries": len(requested),
+            "unique_queries": len(unique_queries),
+            # Queries answered with another query's results: {requested: searched}
+            "merged_queries": {query: searched for query, searched in mapping.items() if query != searched},
+            "usage": usage
+        }
+    }
@@ -0,0 +1,64 @@
+import os
+import json
+import threading
+import requests
+from typing import List, Dict, Optional
+from langchain_core.messages import HumanMessage, ToolMessage
+
+
+# Bounds Serper calls left running by a cancelled or timed-out node
+SERPER_TIMEOUT_SECONDS = 30
+
+# Serper Search Tool
+class SerperSearchTool:
+    def __init__(self, api_key=None, cache=None):
+        self.api_key = api_key or os.getenv("SERPER_API_KEY")
+        self.cache = cache
+        # Real Serper API calls made by this tool; cache hits are not counted
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def search(self, query: str, num_results: int = 5) -> List[Dict]:
+        if self.cache is not None:
+            return self.cache.get_or_fetch((query, num_results), lambda: self.fetch(query, num_results))
+        return self.fetch(query, num_results)
+
+    def fetch(self, query: str, num_results: int = 5) -> List[Dict]:
+        with self.lock:
+            self.calls += 1
+
+        url = "https://google.serper.dev/search"
+        payload = json.dumps({
+            "q": query,
+            "num": num_results
+        })
+        headers = {
+            'X-API-KEY': self.api_key,
+            'Content-Type': 'application/json'
+        }
+        response = requests.request("POST", url, headers=headers, data=payload, timeout=SERPER_TIMEOUT_SECONDS)
+        return response.json()
+
+
+# Format results to be more readable
+def format_search_results(results: Dict) -> str:
+    formatted_results = []
+    for idx, result in enumerate(results.get("organic", [])):
+        formatted_results.append(f"{idx+1}. {result.get('title', 'No title')}")
+        formatted_results.append(f"   URL: {result.get('link', 'No link')}")
+        formatted_results.append(f"   Snippet: {result.get('snippet', 'No snippet')}")
+        formatted_results.append("")
+    return "\n".join(formatted_results)
+
+
+# Shared evidence pool entries an agent has not already seen as tool results
+def shared_evidence_message(evidence_pool: Dict[str, str], conversation: List) -> Optional[HumanMessage]:
+    seen = {message.content for message in conversation if isinstance(message, ToolMessage)}
+    entries = [
+        f"Search: {query}\n{results}"
+        for query, results in (evidence_pool or {}).items()
+        if results and results not in seen
+    ]
+    if not entries:
+        return None
+    return HumanMessage(content="Additional research gathered for this request by the other agents:\n\n" + "\n\n".join(entries))
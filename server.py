@@ -1,14 +1,18 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import Annotated, List, Literal, Optional, Dict, Any
 import asyncio
+import json
+import threading
 import uvicorn
 from datetime import datetime
 import logging
 from enum import Enum
 
-from main import run_marketing_agent, create_marketing_agent_graph
+from main import run_marketing_agent, run_marketing_agent_batch, DEFAULT_BATCH_CONCURRENCY
+from cancellation import cancel_run
 import os
 
 # Configure logging
@@ -39,9 +43,25 @@ class AgentType(str, Enum):
     marketing_strategy = "marketing_strategy"
     content_delivery = "content_delivery"
 
+# Graph nodes that accept a timeout, plus "default" for all of them
+TimeoutNode = Literal["default", "supervisor", "search_planner", "market_research", "marketing_strategy", "content_delivery"]
+PositiveSeconds = Annotated[float, Field(gt=0)]
+
 class MarketingRequest(BaseModel):
     query: str = Field(..., description="Marketing query or request", min_length=10, max_length=1000)
     specific_agents: Optional[List[AgentType]] = Field(None, description="Specific agents to run (optional - will auto-route if not provided)")
+    speculative: bool = Field(False, description="Start likely agents' planning while the supervisor is still routing")
+    search_planning: bool = Field(False, description="Merge all selected agents' searches into one shared, deduplicated search wave")
+    timeout_seconds: Optional[float] = Field(None, gt=0, description="Per-request timeout; unfinished agents are marked as timed out")
+    node_timeouts: Optional[Dict[TimeoutNode, PositiveSeconds]] = Field(None, description="Per-node timeouts in seconds, keyed by node name or 'default'")
+
+class BatchMarketingRequest(BaseModel):
+    queries: List[Annotated[str, Field(min_length=10, max_length=1000)]] = Field(..., description="Marketing queries to analyze", min_length=1, max_length=500)
+    specific_agents: Optional[List[AgentType]] = Field(None, description="Agents to run for every query (optional - will batch auto-route if not provided)")
+    max_concurrency: int = Field(DEFAULT_BATCH_CONCURRENCY, ge=1, le=16, description="Maximum number of queries analyzed at once")
+    search_planning: bool = Field(False, description="Merge each query's agent searches into one shared, deduplicated search wave")
+    timeout_seconds: Optional[float] = Field(None, gt=0, description="Per-query timeout; unfinished agents are marked as timed out")
+    node_timeouts: Optional[Dict[TimeoutNode, PositiveSeconds]] = Field(None, description="Per-node timeouts in seconds, keyed by node name or 'default'")
 
 class MarketingResponse(BaseModel):
     success: bool
@@ -50,6 +70,10 @@ class MarketingResponse(BaseModel):
     selected_agents: List[str]
     results: Dict[str, Any]
     formatted_output: str
+    speculation_report: Dict[str, Any] = {}
+    search_report: Dict[str, Any] = {}
+    status: str = "complete"
+    timed_out_agents: List[str] = []
     processing_time_seconds: float
     timestamp: datetime
 
@@ -68,12 +92,31 @@ class ErrorResponse(BaseModel):
 request_history: Dict[str, MarketingResponse] = {}
 MAX_HISTORY_SIZE = 1000  
 
+# How often a running request checks whether its client has gone away
+DISCONNECT_POLL_SECONDS = 1.0
+
 
 def generate_request_id() -> str:
     """Generate a unique request ID"""
     import uuid
     return str(uuid.uuid4())[:8]
 
+async def run_until_disconnect(http_request: Request, run_id: str, func, *args, **kwargs):
+    """Run a blocking agent call in a thread, cancelling the run if the client disconnects"""
+    task = asyncio.ensure_future(asyncio.to_thread(func, *args, run_id=run_id, **kwargs))
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                logger.info(f"Client disconnected, cancelling request {run_id}")
+                cancel_run(run_id)
+                return await task
+    except asyncio.CancelledError:
+        cancel_run(run_id)
+        raise
+
 @app.get("/", tags=["Root"])
 async def root():
     """Root endpoint with API information"""
@@ -94,12 +137,13 @@ async def health_check():
     )
 
 @app.post("/analyze", response_model=MarketingResponse, tags=["Marketing"])
-async def analyze_marketing_request(request: MarketingRequest):
+async def analyze_marketing_request(request: MarketingRequest, http_request: Request):
     """
     Analyze marketing request using AI agents
     
     - **query**: Your marketing question or request
     - **specific_agents**: Optional list of specific agents to run
+    - **timeout_seconds** / **node_timeouts**: Optional limits; agents that miss them are reported as timed out
     """
     request_id = generate_request_id()
     start_time = datetime.now()
@@ -108,27 +152,25 @@ async def analyze_marketing_request(request: MarketingRequest):
         logger.info(f"Processing request {request_id}: {request.query[:100]}...")
         
         # If specific agents are provided, override the supervisor routing
+        selected_agent_values = None
         if request.specific_agents:
             selected_agent_values = [agent.value for agent in request.specific_agents]
             logger.info(f"Using specific agents: {selected_agent_values}")
-            
-            # Create a modified state with pre-selected agents
-            from state import OverallState
-            initial_state = {
-                "user_input": request.query,
-                "selected_agents": selected_agent_values,
-                "agent_responses": {},
-                "execution_progress": [],
-                "graph_output": ""
-            }
-            
-            # Create and run the graph with pre-selected agents
-            graph = create_marketing_agent_graph()
-            result = await asyncio.to_thread(graph.invoke, initial_state)
         else:
             # Use normal routing through supervisor
             logger.info("No specific agents provided, using auto-routing")
-            result = await asyncio.to_thread(run_marketing_agent, request.query)
+        
+        result = await run_until_disconnect(
+            http_request,
+            request_id,
+            run_marketing_agent,
+            request.query,
+            speculative=request.speculative,
+            search_planning=request.search_planning,
+            selected_agents=selected_agent_values,
+            request_timeout=request.timeout_seconds,
+            node_timeouts=request.node_timeouts
+        )
         
         end_time = datetime.now()
         processing_time = (end_time - start_time).total_seconds()
@@ -145,6 +187,10 @@ async def analyze_marketing_request(request: MarketingRequest):
             selected_agents=selected_agents,
             results=result.get("agent_responses", {}),
             formatted_output=result.get("graph_output", ""),
+            speculation_report=result.get("speculation_report") or {},
+            search_report=result.get("search_report") or {},
+            status=result.get("status") or "complete",
+            timed_out_agents=result.get("timed_out_agents") or [],
             processing_time_seconds=processing_time,
             timestamp=end_time
         )
@@ -169,6 +215,64 @@ async def analyze_marketing_request(request: MarketingRequest):
         )
         raise HTTPException(status_code=500, detail=error_response.dict())
 
+@app.post("/analyze/batch", tags=["Marketing"])
+async def analyze_marketing_batch(request: BatchMarketingRequest):
+    """
+    Analyze many marketing requests as one batch
+    
+    Streams newline-delimited JSON: one "item" event per query as it completes,
+    then a single "report" event with progress and cost totals. Routing, searches
+    and identical queries are shared across the batch.
+    """
+    batch_id = generate_request_id()
+    logger.info(f"Processing batch {batch_id} with {len(request.queries)} queries")
+    
+    selected_agents = [agent.value for agent in request.specific_agents] if request.specific_agents else None
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    finished = object()
+    stop = threading.Event()
+    
+    def produce():
+        try:
+            events = run_marketing_agent_batch(
+                request.queries,
+                max_concurrency=request.max_concurrency,
+                batch_id=batch_id,
+                selected_agents=selected_agents,
+                search_planning=request.search_planning,
+                request_timeout=request.timeout_seconds,
+                node_timeouts=request.node_timeouts
+            )
+            for event in events:
+                if stop.is_set():
+                    # Closing the generator cancels and releases the rest of the batch
+                    events.close()
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+        except Exception as e:
+            logger.error(f"Error processing batch {batch_id}: {str(e)}")
+            loop.call_soon_threadsafe(queue.put_nowait, {"type": "error", "batch_id": batch_id, "error": str(e)})
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, finished)
+    
+    async def stream():
+        producer = asyncio.ensure_future(asyncio.to_thread(produce))
+        try:
+            while True:
+                event = await queue.get()
+                if event is finished:
+                    break
+                yield json.dumps(event, default=str) + "\n"
+        finally:
+            # No-op once the batch has finished; cancels it if the client went away
+            stop.set()
+            cancel_run(batch_id)
+            if not producer.done():
+                producer.cancel()
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
 @app.get("/history", tags=["History"])
 async def get_request_history(limit: int = 10):
     """Get recent request history"""
@@ -227,14 +331,17 @@ async def get_available_agents():
     }
 
 @app.post("/agents/{agent_name}", tags=["Agents"])
-async def run_specific_agent(agent_name: AgentType, request: MarketingRequest):
+async def run_specific_agent(agent_name: AgentType, request: MarketingRequest, http_request: Request):
     """Run a specific agent directly"""
     # Create a new request with the specific agent
     specific_request = MarketingRequest(
         query=request.query,
-        specific_agents=[agent_name]
+        specific_agents=[agent_name],
+        search_planning=request.search_planning,
+        timeout_seconds=request.timeout_seconds,
+        node_timeouts=request.node_timeouts
     )
-    return await analyze_marketing_request(specific_request)
+    return await analyze_marketing_request(specific_request, http_request)
 
 if __name__ == "__main__":
     uvicorn.run(
@@ -0,0 +1,157 @@
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from state import empty_usage, add_usage
+
+
+# Keyword hints used to guess which agents the router is likely to select
+LIKELY_AGENT_PATTERNS = {
+    "market_research": r"market|research|industry|competit|audience|analy",
+    "marketing_strategy": r"strateg|position|go-to-market|pricing|launch|acquisition|differentiat",
+    "content_delivery": r"content|social|post|video|\bads?\b|advertis|campaign|tiktok|instagram",
+}
+
+ALL_AGENTS = list(LIKELY_AGENT_PATTERNS.keys())
+
+
+def guess_likely_agents(user_input: str) -> List[str]:
+    """Cheap routing guess; speculates on every agent when nothing matches"""
+    text = user_input.lower()
+    likely = [agent for agent, pattern in LIKELY_AGENT_PATTERNS.items() if re.search(pattern, text)]
+    return likely or ALL_AGENTS
+
+
+# Planning work started ahead of the supervisor's routing decision
+class SpeculativeRun:
+    def __init__(self, user_input: str, planners: Dict[str, Callable], run_context=None):
+        # With a run context, each plan stops with its agent's node: on request
+        # cancellation or when that node times out
+        self.cancel_events = {
+            agent: run_context.node_event(agent) if run_context is not None else threading.Event()
+            for agent in planners
+        }
+        self.executor = ThreadPoolExecutor(max_workers=max(len(planners), 1), thread_name_prefix="speculative")
+        self.futures = {
+            agent: self.executor.submit(planner, user_input, {}, self.cancel_events[agent])
+            for agent, planner in planners.items()
+        }
+        self.promoted = []
+        self.discarded = []
+        self.cancelled = []
+        self.resolved = False
+
+    def resolve(self, selected_agents: List[str]):
+        """
+        Promote the plans the router confirmed and cancel the rest. A discarded
+        plan whose tool-planning LLM call is already in flight still finishes
+        (and pays for) that call; only its searches are skipped.
+        """
+        for agent, future in self.futures.items():
+            if agent in selected_agents:
+                self.promoted.append(agent)
+                continue
+            self.cancel_events[agent].set()
+            if future.cancel():
+                self.cancelled.append(agent)
+            else:
+                self.discarded.append(agent)
+        self.resolved = True
+
+    def claim(self, agent: str) -> Optional[Dict]:
+        if agent not in self.promoted:
+            return None
+        try:
+            return self.futures[agent].result()
+        except Exception as e:
+            print(f"Speculative planning failed for {agent}, replanning: {e}")
+            return None
+
+    def close(self, wait: bool = True) -> Dict:
+        """
+        Without wait, plans still running are abandoned (they stop at their next
+        search) and their cost is missing from the report, listed under "pending".
+        """
+        if not self.resolved:
+            self.resolve([])
+        if not wait:
+            for event in self.cancel_events.values():
+                event.set()
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
+
+        promoted_usage = empty_usage()
+        wasted_usage = empty_usage()
+        pending = []
+        for agent, future in self.futures.items():
+            if not future.done():
+                pending.append(agent)
+                continue
+            if future.cancelled() or future.exception() is not None:
+                continue
+            if agent in self.promoted:
+                add_usage(promoted_usage, future.result()["usage"])
+            else:
+                add_usage(wasted_usage, future.result()["usage"])
+
+        return {
+            "speculated": list(self.futures.keys()),
+            "promoted": self.promoted,
+            "discarded": self.discarded,
+            "cancelled": self.cancelled,
+            "pending": pending,
+            "promoted_usage": promoted_usage,
+            "wasted_usage": wasted_usage,
+        }
+
+
+# Registry of in-flight runs, keyed by the speculation_id carried in graph state
+_runs: Dict[str, SpeculativeRun] = {}
+_runs_lock = threading.Lock()
+
+
+def new_speculation_id() -> str:
+    return uuid.uuid4().hex[:8]
+
+
+def start_speculation(speculation_id: str, user_input: str, planners: Dict[str, Callable], run_context=None):
+    run = SpeculativeRun(user_input, planners, run_context)
+    with _runs_lock:
+        _runs[speculation_id] = run
+
+
+def resolve_speculation(speculation_id: str, selected_agents: List[str]):
+    with _runs_lock:
+        run = _runs.get(speculation_id)
+    if run is not None:
+        run.resolve(selected_agents)
+
+
+def promoted_agents(speculation_id: str) -> List[str]:
+    with _runs_lock:
+        run = _runs.get(speculation_id) if speculation_id else None
+    return list(run.promoted) if run is not None else []
+
+
+def claim_plan(state: Dict, agent: str) -> Optional[Dict]:
+    """Return the promoted speculative plan for an agent, if there is one"""
+    speculation_id = state.get("speculation_id")
+    if not speculation_id:
+        return None
+    with _runs_lock:
+        run = _runs.get(speculation_id)
+    if run is None:
+        return None
+    return run.claim(agent)
+
+
+def finish_speculation(speculation_id: str, wait: bool = True) -> Dict:
+    """Wait for (or abandon) leftover speculative work and return its cost report"""
+    if not speculation_id:
+        return {}
+    with _runs_lock:
+        run = _runs.pop(speculation_id, None)
+    if run is None:
+        return {}
+    return run.close(wait)
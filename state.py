@@ -8,13 +8,38 @@ def merge_dicts(existing_dict, new_dict):
             merged[key] = value
     return merged
 
+# Usage accounting helpers (LLM tokens and Serper calls)
+def empty_usage():
+    return {"llm_calls": 0, "input_tokens": 0, "output_tokens": 0, "serper_calls": 0}
+
+def add_usage(total, usage):
+    for key, value in usage.items():
+        total[key] = total.get(key, 0) + value
+    return total
+
+def sum_usage(existing, new):
+    return add_usage(dict(existing or {}), new or {})
+
+def record_llm_usage(usage, response):
+    metadata = getattr(response, "usage_metadata", None) or {}
+    usage["llm_calls"] += 1
+    usage["input_tokens"] += metadata.get("input_tokens", 0)
+    usage["output_tokens"] += metadata.get("output_tokens", 0)
+    return usage
+
 
 class InputState(TypedDict):
     user_input: str
 
 class OutputState(TypedDict):
     graph_output: str
+    selected_agents: list
     agent_responses: Annotated[dict, merge_dicts]
+    speculation_report: dict
+    search_report: dict
+    timed_out_agents: Annotated[list, operator.add]
+    status: str
+    usage: Annotated[dict, sum_usage]
 
 class OverallState(TypedDict):
     user_input: str
@@ -22,7 +47,26 @@ class OverallState(TypedDict):
     agent_responses: Annotated[dict, merge_dicts]
     execution_progress: Annotated[list, operator.add]
     graph_output: str
+    run_id: str
+    timed_out_agents: Annotated[list, operator.add]
+    status: str
+    usage: Annotated[dict, sum_usage]
+    search_cache_id: str
+    speculation_id: str
+    speculation_report: dict
+    search_planning: bool
+    search_plans: dict
+    evidence_pool: dict
+    search_report: dict
 
 # Supervisor Agent Router Logic
 class AgentRouter(TypedDict):
-    selected_agents: List[Literal["market_research", "marketing_strategy", "content_delivery"]] 
\ No newline at end of file
+    selected_agents: List[Literal["market_research", "marketing_strategy", "content_delivery"]]
+
+# Batch Router Logic: one routing decision per numbered request
+class BatchRoute(TypedDict):
+    index: int
+    selected_agents: List[Literal["market_research", "marketing_strategy", "content_delivery"]]
+
+class BatchRouter(TypedDict):
+    routes: List[BatchRoute] 
\ No newline at end of file